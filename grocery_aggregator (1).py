@@ -8,12 +8,25 @@ Kroger API (requires client ID and secret).
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 import random
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import base64
+import hashlib
+import zlib
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import altair as alt
 
+try:
+    # orjson parses large product payloads several times faster than json
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 # --- APP CONFIGURATION ---
 st.set_page_config(
     page_title="Local Grocery Price Aggregator",
@@ -23,128 +36,288 @@ st.set_page_config(
 
 # --- MOCK DATA GENERATOR (SIMULATION MODE) ---
 # This allows the user to test the app without needing API keys immediately.
+_STORE_CHAINS = ("Kroger", "Walmart", "Aldi", "Whole Foods", "Trader Joe's", "Safeway")
+
+@st.cache_data(show_spinner=False)
 def get_mock_stores(zip_code):
     """Generates fake stores based on a zip code to demonstrate functionality."""
-    random.seed(zip_code) # Seed so the same zip always yields the same 'random' stores
-    store_chains = ["Kroger", "Walmart", "Aldi", "Whole Foods", "Trader Joe's", "Safeway"]
+    # Seed so the same zip always yields the same 'random' stores. A local
+    # generator keeps this re-entrant and leaves the global RNG untouched.
+    rng = random.Random(zip_code)
 
     # Randomly select 3-5 stores for this area
-    num_stores = random.randint(3, 5)
-    selected_chains = random.sample(store_chains, num_stores)
-
-    stores = []
-    for chain in selected_chains:
-        stores.append({
-            "name": chain,
-            "location_id": f"LOC-{random.randint(1000, 9999)}",
-            "address": f"{random.randint(100, 999)} Main St, Zip {zip_code}",
-            "distance": f"{random.randint(1, 10)} miles"
-        })
-    return stores
-
+    num_stores = rng.randint(3, 5)
+    selected_chains = rng.sample(_STORE_CHAINS, num_stores)
+
+    # Stores are returned as columns (dict of lists) so they feed straight into a DataFrame
+    loc_ids = [f"LOC-{rng.randint(1000, 9999)}" for _ in range(num_stores)]
+    addrs = [f"{rng.randint(100, 999)} Main St, Zip {zip_code}" for _ in range(num_stores)]
+    dists = [f"{rng.randint(1, 10)} miles" for _ in range(num_stores)]
+    return {
+        "name": selected_chains,
+        "location_id": loc_ids,
+        "address": addrs,
+        "distance": dists
+    }
+
+def _gen_prices(seed, n):
+    """Numeric core of the price simulation: per-store prices and a stock mask."""
+    # A local Generator keeps this re-entrant and leaves numpy's global RNG untouched
+    rng = np.random.default_rng(seed)
+    base = rng.uniform(2.50, 15.00) # Random base price for the item
+    # Vary price by +/- 20% per store to simulate competition
+    variance = rng.uniform(0.8, 1.2, n)
+    prices = np.round(base * variance, 2)
+    # Simulate stock status (~75% of stores carry the item)
+    mask = rng.random(n) > 0.25
+    return prices, mask
+
+@st.cache_data(show_spinner=False)
 def get_mock_prices(item_name, stores):
     """Generates fake prices for an item across the found stores."""
-    random.seed(item_name) # Seed so "Milk" always costs the same in a session
-
-    results = []
-    base_price = random.uniform(2.50, 15.00) # Random base price for the item
-
-    for store in stores:
-        # Vary price by +/- 20% per store to simulate competition
-        variance = random.uniform(0.8, 1.2)
-        price = round(base_price * variance, 2)
-
-        # Simulate stock status
-        in_stock = random.choice([True, True, True, False])
-
-        if in_stock:
-            results.append({
-                "Store": store['name'],
-                "Item": item_name.title(),
-                "Price": price,
-                "Address": store['address'],
-                "Stock": "In Stock"
-            })
-        else:
-            results.append({
-                "Store": store['name'],
-                "Item": item_name.title(),
-                "Price": None,
-                "Address": store['address'],
-                "Stock": "Out of Stock"
-            })
-
-    return pd.DataFrame(results)
+    # Seed so "Milk" always costs the same (crc32 is stable across processes, unlike hash())
+    prices, in_stock = _gen_prices(zlib.crc32(item_name.encode()), len(stores['name']))
+    prices = np.where(in_stock, prices, np.nan)
+
+    # Build the frame column-wise rather than from a list of per-row dicts
+    return pd.DataFrame({
+        "Store": stores['name'],
+        "Item": item_name.title(),
+        "Price": prices,
+        "Address": stores['address'],
+        "Stock": np.where(in_stock, "In Stock", "Out of Stock")
+    })
 
 # --- REAL KROGER API INTEGRATION ---
+# Network calls live in module-level cached functions so Streamlit reruns
+# (which happen on every widget interaction) reuse earlier responses instead
+# of hitting the Kroger endpoints again.
+KROGER_BASE_URL = "https://api-ce.kroger.com/v1"
+
+def _client_key(client_id):
+    """Hashes the client ID so raw credentials aren't used as cache keys."""
+    return hashlib.sha256(client_id.encode()).hexdigest()
+
+def _encode_credentials(client_id, client_secret):
+    credentials = f"{client_id}:{client_secret}"
+    return base64.b64encode(credentials.encode()).decode()
+
+def _fetch_token(client_id, client_secret, session):
+    """Authenticates with Kroger using Client Credentials.
+
+    Returns (token, expires_at) where expires_at is a time.time() timestamp.
+    Raises requests.RequestException on HTTP failure, or ValueError if the
+    body isn't valid JSON.
+    """
+    url = f"{KROGER_BASE_URL}/connect/oauth2/token"
+    headers = {
+        "Content-Type": "application/x-www-form-urlencoded",
+        "Authorization": f"Basic {_encode_credentials(client_id, client_secret)}"
+    }
+    data = {"grant_type": "client_credentials", "scope": "product.compact"}
+
+    response = session.post(url, headers=headers, data=data)
+    response.raise_for_status()
+    payload = json_loads(response.content)
+    return payload.get("access_token"), time.time() + payload.get("expires_in", 1800)
+
+# A leading underscore on `_session` tells st.cache_data not to hash it; the
+# cache is keyed on the client hash and the query arguments instead. The
+# session already carries the Accept and Bearer headers. Error responses
+# raise rather than return, since st.cache_data doesn't cache exceptions.
+@st.cache_data(ttl=300, show_spinner=False)
+def _fetch_locations(client_id_hash, _session, zip_code, radius_miles=10):
+    """Fetches real store locations near a zip code."""
+    url = f"{KROGER_BASE_URL}/locations"
+    params = {"filter.zipCode.near": zip_code, "filter.limit": 5, "filter.radiusInMiles": radius_miles}
+
+    response = _session.get(url, params=params)
+    response.raise_for_status()
+    data = json_loads(response.content).get('data', [])
+    return {
+        "name": [d.get('name') for d in data],
+        "location_id": [d.get('locationId') for d in data],
+        "address": [d.get('address', {}).get('addressLine1', 'Unknown') for d in data]
+    }
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _fetch_product_price(client_id_hash, _session, location_id, term):
+    """Fetches product price for a specific store location."""
+    url = f"{KROGER_BASE_URL}/products"
+    params = {"filter.term": term, "filter.locationId": location_id, "filter.limit": 1}
+
+    response = _session.get(url, params=params)
+    response.raise_for_status()
+    data = json_loads(response.content).get('data', [])
+    if data:
+        # Extracting the regular price from the first result
+        items = data[0].get('items', [])
+        if items:
+            price_info = items[0].get('price', {}).get('regular', 0)
+            return price_info
+    return None
+
+class KrogerAuthError(Exception):
+    """Raised when a Kroger client could not be authenticated."""
+
 # This class handles the connection if the user provides keys.
 class KrogerAPI:
     def __init__(self, client_id, client_secret):
-        self.base_url = "https://api-ce.kroger.com/v1"
+        self.base_url = KROGER_BASE_URL
         self.client_id = client_id
         self.client_secret = client_secret
-        self.token = self._get_access_token()
+        self.client_key = _client_key(client_id)
+        # Shared by all requests (including worker threads) so TCP/TLS
+        # connections are reused instead of re-negotiated per call.
+        self.session = requests.Session()
+        # raise_on_status=False hands back the final error response once retries
+        # run out, instead of raising RetryError past the status checks.
+        retries = Retry(total=2, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504],
+                        raise_on_status=False)
+        self.session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retries))
+        self.session.headers.update({"Accept": "application/json"})
+        # get_api shares this client across browser sessions, so the instance
+        # (not st.session_state) owns the token; the lock serialises refreshes.
+        self.token = None
+        self.token_expires_at = 0
+        self._token_lock = threading.Lock()
+        self._ensure_token()
 
     def _get_access_token(self):
-        """Authenticates with Kroger using Client Credentials."""
-        url = f"{self.base_url}/connect/oauth2/token"
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded",
-            "Authorization": f"Basic {self._encode_credentials()}"
-        }
-        data = {"grant_type": "client_credentials", "scope": "product.compact"}
-
+        """Authenticates and returns (token, expires_at), or (None, 0) on failure."""
         try:
-            response = requests.post(url, headers=headers, data=data)
-            response.raise_for_status()
-            return response.json().get("access_token")
-        except Exception as e:
+            token, expires_at = _fetch_token(self.client_id, self.client_secret, self.session)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 401:
+                st.error("Authentication Failed: invalid Kroger client ID or secret.")
+            else:
+                st.error(f"Authentication Failed: {e}")
+            return None, 0
+        except (requests.RequestException, ValueError) as e:
+            # ValueError covers non-JSON bodies (e.g. an HTML gateway page)
             st.error(f"Authentication Failed: {e}")
-            return None
-
-    def _encode_credentials(self):
-        credentials = f"{self.client_id}:{self.client_secret}"
-        return base64.b64encode(credentials.encode()).decode()
+            return None, 0
+        if not token:
+            st.error("Authentication Failed: Kroger returned no access token.")
+            return None, 0
+        return token, expires_at
+
+    def _ensure_token(self):
+        """Returns a valid bearer token, refreshing it shortly before it expires.
+
+        The Authorization header is only replaced when a new token is issued,
+        and is never removed, so in-flight requests always send a header.
+        """
+        with self._token_lock:
+            if self.token and time.time() < self.token_expires_at - 30:
+                return self.token
+
+            token, expires_at = self._get_access_token()
+            self.token, self.token_expires_at = token, expires_at
+            if token:
+                self.session.headers["Authorization"] = f"Bearer {token}"
+            return token
+
+    def _invalidate_token(self, rejected):
+        """Drops a token the API answered 401 to, so the next _ensure_token()
+        fetches a new one instead of reusing it until its local expiry."""
+        with self._token_lock:
+            # Another thread may already have replaced it
+            if self.token == rejected:
+                self.token, self.token_expires_at = None, 0
 
     def get_locations(self, zip_code, radius_miles=10):
         """Fetches real store locations near a zip code."""
-        if not self.token: return []
-
-        url = f"{self.base_url}/locations"
-        headers = {"Accept": "application/json", "Authorization": f"Bearer {self.token}"}
-        params = {"filter.zipCode.near": zip_code, "filter.limit": 5, "filter.radiusInMiles": radius_miles}
-
-        response = requests.get(url, headers=headers, params=params)
-        if response.status_code == 200:
-            data = response.json().get('data', [])
-            stores = []
-            for d in data:
-                stores.append({
-                    "name": d.get('name'),
-                    "location_id": d.get('locationId'),
-                    "address": d.get('address', {}).get('addressLine1', 'Unknown')
-                })
-            return stores
-        return []
+        for attempt in range(2):
+            token = self._ensure_token()
+            if not token: return {}
+            try:
+                return _fetch_locations(self.client_key, self.session, zip_code, radius_miles)
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code != 401:
+                    return {}
+                # Token was rejected (revoked or expired early); retry once with a new one
+                self._invalidate_token(token)
+            except (requests.RequestException, ValueError):
+                return {}
+        return {}
 
     def get_product_price(self, term, location_id):
         """Fetches product price for a specific store location."""
-        if not self.token: return None
-
-        url = f"{self.base_url}/products"
-        headers = {"Accept": "application/json", "Authorization": f"Bearer {self.token}"}
-        params = {"filter.term": term, "filter.locationId": location_id, "filter.limit": 1}
-
-        response = requests.get(url, headers=headers, params=params)
-        if response.status_code == 200:
-            data = response.json().get('data', [])
-            if data:
-                # Extracting the regular price from the first result
-                items = data[0].get('items', [])
-                if items:
-                    price_info = items[0].get('price', {}).get('regular', 0)
-                    return price_info
-        return None
+        token = self.token
+        if not token: return None
+        try:
+            return _fetch_product_price(self.client_key, self.session, location_id, term)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 401:
+                self._invalidate_token(token)
+            return None
+        except (requests.RequestException, ValueError):
+            return None
+
+    def _fetch_prices_concurrently(self, term, location_ids):
+        prices = {}
+        if not location_ids: return prices
+
+        with ThreadPoolExecutor(max_workers=min(16, len(location_ids))) as ex:
+            futures = {ex.submit(self.get_product_price, term, loc_id): loc_id for loc_id in location_ids}
+            for future in as_completed(futures):
+                # One failing store shouldn't discard the prices already fetched
+                try:
+                    prices[futures[future]] = future.result()
+                except Exception:
+                    prices[futures[future]] = None
+        return prices
+
+    def get_product_prices_bulk(self, term, location_ids):
+        """Fetches product prices for several store locations.
+
+        Returns a dict mapping location_id -> price (None if unavailable).
+        The products endpoint only prices one location per request, so the
+        lookups are fanned out concurrently over the shared session.
+        """
+        if not location_ids or not self._ensure_token(): return {}
+
+        prices = self._fetch_prices_concurrently(term, location_ids)
+        # A 401 in a worker invalidates the token; refresh it here on the
+        # script thread and retry the stores that came back empty once.
+        if self.token is None and self._ensure_token():
+            missing = [loc_id for loc_id, price in prices.items() if price is None]
+            prices.update(self._fetch_prices_concurrently(term, missing))
+        return prices
+
+# One client per set of credentials, reused across reruns so __init__
+# (session setup, OAuth) is skipped. The token itself is refreshed on demand.
+# Failed logins raise, so an unauthenticated client is never cached.
+@st.cache_resource(show_spinner=False)
+def get_api(client_id, client_secret):
+    api = KrogerAPI(client_id, client_secret)
+    if not api.token:
+        raise KrogerAuthError("Could not authenticate with the Kroger API.")
+    return api
+
+# --- RESULT PREPARATION ---
+@st.cache_data(show_spinner=False)
+def _prepare_results(df_prices):
+    """Returns (best_deal, valid_prices); best_deal is None if nothing is priced."""
+    # Clean up data for display (remove out of stock for the chart)
+    valid_prices = df_prices.dropna(subset=['Price']).sort_values(by='Price')
+    if valid_prices.empty:
+        return None, valid_prices
+    return valid_prices.iloc[0].to_dict(), valid_prices
+
+@st.cache_data(show_spinner=False)
+def _build_chart(valid_prices, title):
+    """Builds the price comparison bar chart as a Vega-Lite spec."""
+    return alt.Chart(valid_prices).mark_bar().encode(
+        x=alt.X('Store', sort='y'),
+        y=alt.Y('Price', axis=alt.Axis(format='$%.2f')),
+        color=alt.Color('Store'),
+        tooltip=['Store', 'Price', 'Address']
+    ).properties(
+        height=300,
+        title=title
+    ).interactive().to_dict()
 
 # --- MAIN APP UI ---
 
@@ -163,6 +336,10 @@ with st.sidebar:
 
     client_id = ""
     client_secret = ""
+    simulate_delay = False
+
+    if mode == "Simulation Mode (Mock Data)":
+        simulate_delay = st.checkbox("Simulate network delay", value=False)
 
     if mode == "Real Kroger API":
         st.info("To get keys, visit: developer.kroger.com")
@@ -175,26 +352,33 @@ if user_zip:
     st.divider()
     st.subheader(f"📍 Stores near {user_zip}")
 
-    stores = []
+    stores = {}
+    api = None
 
     # 1. FETCH STORES
     if mode == "Simulation Mode (Mock Data)":
         stores = get_mock_stores(user_zip)
-        st.success(f"Found {len(stores)} stores (Simulated)")
+        st.success(f"Found {len(stores['name'])} stores (Simulated)")
 
     elif mode == "Real Kroger API" and client_id and client_secret:
         with st.spinner("Connecting to Kroger API..."):
-            api = KrogerAPI(client_id, client_secret)
-            stores = api.get_locations(user_zip)
-            if stores:
-                st.success(f"Found {len(stores)} Kroger locations.")
+            try:
+                api = get_api(client_id, client_secret)
+                stores = api.get_locations(user_zip)
+            except KrogerAuthError:
+                pass # The authentication error has already been shown
+            if stores.get('name'):
+                st.success(f"Found {len(stores['name'])} Kroger locations.")
             else:
                 st.warning("No stores found or API Error.")
 
     # Display Stores found
-    if stores:
-        store_df = pd.DataFrame(stores)
-        st.dataframe(store_df[['name', 'address']], use_container_width=True)
+    if stores.get('name'):
+        # Only the displayed columns are handed to pandas; no full frame + projection
+        st.dataframe(
+            pd.DataFrame({"name": stores['name'], "address": stores['address']}),
+            use_container_width=True
+        )
 
         # 2. SEARCH PRODUCTS
         st.divider()
@@ -203,74 +387,77 @@ if user_zip:
         item_query = st.text_input("What are you looking for?", placeholder="e.g., Milk, Bread, Eggs")
         search_btn = st.button("Find Cheapest Price")
 
-        if search_btn and item_query:
-            price_data = []
+        # Results are kept in session state so reruns triggered by other
+        # widgets reuse them instead of rebuilding every frame. A button press
+        # always recomputes, and the key includes the account being used.
+        account_key = api.client_key if api is not None else None
+        results_key = (user_zip, item_query, mode, account_key)
 
+        if search_btn and item_query:
             with st.spinner(f"Checking prices for '{item_query}'..."):
                 if mode == "Simulation Mode (Mock Data)":
-                    time.sleep(1.0) # Fake network delay for realism
+                    if simulate_delay:
+                        time.sleep(1.0) # Fake network delay for realism
                     df_prices = get_mock_prices(item_query, stores)
 
                 elif mode == "Real Kroger API":
                     # Logic to fetch real prices from the found locations
-                    real_results = []
-                    progress_bar = st.progress(0)
-                    if 'api' in locals():
-                        for i, store in enumerate(stores):
-                            price = api.get_product_price(item_query, store['location_id'])
-                            real_results.append({
-                                "Store": store['name'],
-                                "Item": item_query,
-                                "Price": price if price else None,
-                                "Address": store['address'],
-                                "Stock": "Unknown"
-                            })
-                            progress_bar.progress((i + 1) / len(stores))
-                        df_prices = pd.DataFrame(real_results)
+                    if api is not None:
+                        prices = api.get_product_prices_bulk(item_query, stores['location_id'])
+                        df_prices = pd.DataFrame({
+                            "Store": stores['name'],
+                            "Item": item_query,
+                            "Price": [prices.get(loc_id) or None for loc_id in stores['location_id']],
+                            "Address": stores['address'],
+                            "Stock": "Unknown"
+                        })
                     else:
                          st.error("API object not initialized. Check your credentials.")
                          df_prices = pd.DataFrame()
 
-
-            # 3. DISPLAY RESULTS
             if not df_prices.empty:
-                # Clean up data for display (remove out of stock for the chart)
-                valid_prices = df_prices.dropna(subset=['Price']).sort_values(by='Price')
-
-                if not valid_prices.empty:
-                    best_deal = valid_prices.iloc[0]
-                    st.metric(
-                        label="🏆 Best Price Found At",
-                        value=f"${best_deal['Price']:.2f}",
-                        delta=best_deal['Store']
-                    )
-
-                    col1, col2 = st.columns([2, 1])
-
-                    with col1:
-                        st.markdown("### Price Comparison")
-                        # Adjust chart to explicitly use the Item title
-                        chart = alt.Chart(valid_prices).mark_bar().encode(
-                            x=alt.X('Store', sort='y'),
-                            y=alt.Y('Price', axis=alt.Axis(format='$%.2f')),
-                            color=alt.Color('Store'),
-                            tooltip=['Store', 'Price', 'Address']
-                        ).properties(
-                            height=300,
-                            title=f"Price Comparison for {item_query.title()}"
-                        ).interactive()
-                        st.altair_chart(chart, use_container_width=True)
-
-                    with col2:
-                        st.markdown("### Details")
-                        st.dataframe(
-                            df_prices[['Store', 'Price', 'Stock']].style.format({"Price": "${:.2f}"}),
-                            use_container_width=True
-                        )
-                else:
-                    st.error(f"Could not find a price for '{item_query}' at any location.")
-            elif search_btn:
+                best_deal, valid_prices = _prepare_results(df_prices)
+                st.session_state.update({
+                    "results_key": results_key,
+                    "best_deal": best_deal,
+                    "valid_prices": valid_prices,
+                    "price_details": df_prices[['Store', 'Price', 'Stock']]
+                })
+            else:
+                # Nothing worth keeping; let the next click retry
+                st.session_state.pop("results_key", None)
                 st.error("No data could be retrieved. Please check your inputs or API keys.")
+
+        # 3. DISPLAY RESULTS
+        if item_query and st.session_state.get("results_key") == results_key:
+            best_deal = st.session_state["best_deal"]
+            valid_prices = st.session_state["valid_prices"]
+
+            if best_deal is not None:
+                st.metric(
+                    label="🏆 Best Price Found At",
+                    value=f"${best_deal['Price']:.2f}",
+                    delta=best_deal['Store']
+                )
+
+                col1, col2 = st.columns([2, 1])
+
+                with col1:
+                    st.markdown("### Price Comparison")
+                    # Adjust chart to explicitly use the Item title
+                    chart = _build_chart(valid_prices, f"Price Comparison for {item_query.title()}")
+                    st.vega_lite_chart(chart, use_container_width=True)
+
+                with col2:
+                    st.markdown("### Details")
+                    # Formatting happens in the frontend, avoiding a server-side Styler
+                    st.dataframe(
+                        st.session_state["price_details"],
+                        column_config={"Price": st.column_config.NumberColumn(format="$%.2f")},
+                        use_container_width=True
+                    )
+            else:
+                st.error(f"Could not find a price for '{item_query}' at any location.")
     else:
         st.info("Enter a valid zip code to find stores.")
 else: